@@ -1,21 +1,36 @@
 import os
 import io
+import asyncio
+import csv
+import hashlib
 import json
+import logging
+import math
 import zipfile
-import shutil
+import tempfile
+import queue
+import threading
 import uuid
-from datetime import datetime
-from typing import Optional, List, Dict, Any
-from fastapi import FastAPI, UploadFile, File, HTTPException
+from contextlib import asynccontextmanager
+from collections import deque
+from concurrent.futures import Future, ThreadPoolExecutor, wait
+from datetime import datetime, timezone
+from itertools import chain, islice, repeat
+from typing import Optional, List, Dict, Any, Union
+from fastapi import FastAPI, UploadFile, File, HTTPException, Query
 from fastapi.middleware.cors import CORSMiddleware
 from fastapi.responses import StreamingResponse
 
+import aiofiles
 from PIL import Image
-import pytesseract
+from tesserocr import PyTessBaseAPI, PSM
 import fitz  # PyMuPDF
-import pandas as pd
+import polars as pl
+import xlsxwriter
 
-from groq import Groq
+import httpx
+import orjson
+from groq import DefaultHttpxClient, Groq
 from sqlalchemy import create_engine, text
 from sqlalchemy.engine import Engine
 from dotenv import load_dotenv
@@ -25,6 +40,8 @@ from dotenv import load_dotenv
 # -----------------------------
 load_dotenv()
 
+logger = logging.getLogger(__name__)
+
 DATABASE_URL = os.getenv("DATABASE_URL")
 GROQ_API_KEY = os.getenv("GROQ_API_KEY")
 
@@ -33,15 +50,69 @@ if not DATABASE_URL:
 if not GROQ_API_KEY:
     raise RuntimeError("GROQ_API_KEY is not set. Set it to your Groq API key.")
 
-client = Groq(api_key=GROQ_API_KEY)
+# One Groq client for the process, on a pooled keep-alive HTTP connection
+client = Groq(
+    api_key=GROQ_API_KEY,
+    http_client=DefaultHttpxClient(limits=httpx.Limits(max_connections=40, max_keepalive_connections=20)),
+)
 
 UPLOAD_DIR = "uploads"
-TMP_DIR = "tmp"
 os.makedirs(UPLOAD_DIR, exist_ok=True)
-os.makedirs(TMP_DIR, exist_ok=True)
 
-# Windows: ensure pytesseract finds tesseract.exe
-pytesseract.pytesseract.tesseract_cmd = r"C:\Program Files\Tesseract-OCR\tesseract.exe"
+# Tesseract traineddata directory; tesserocr's built-in default is used when TESSDATA_PREFIX is unset
+TESSDATA_DIR = os.getenv("TESSDATA_PREFIX")
+
+# Scanned pages are rendered at this DPI in grayscale; plenty for machine-printed text and
+# Tesseract time scales with pixel count.
+OCR_DPI = 150
+
+# Scanned PDF pages are OCR'd in parallel; tesserocr releases the GIL while recognizing.
+OCR_WORKERS = os.cpu_count() or 4
+OCR_POOL = ThreadPoolExecutor(max_workers=OCR_WORKERS, thread_name_prefix="ocr")
+OCR_WINDOW = 2 * OCR_WORKERS  # pages of one PDF queued on OCR_POOL at a time
+
+# In-process Tesseract APIs, at most one per OCR worker, pre-warmed by the lifespan hook so
+# eng.traineddata is loaded at startup rather than on first use. An instance is not
+# re-entrant, so ocr_image checks one out for the duration of a recognition.
+_TESS_POOL: "queue.Queue[PyTessBaseAPI]" = queue.Queue()
+_TESS_LOCK = threading.Lock()
+_tess_created = 0
+
+# Whole-file jobs from /upload run off the event loop here. Kept separate from OCR_POOL:
+# a file job blocks on its page OCR, so sharing one bounded pool could deadlock.
+FILE_POOL = ThreadPoolExecutor(max_workers=8, thread_name_prefix="upload")
+UPLOAD_CHUNK_BYTES = 1024 * 1024
+
+# Files inside a ZIP are processed concurrently on ZIP_POOL; GROQ_SEMAPHORE caps in-flight
+# Groq requests process-wide (lower it if the account starts hitting rate limits).
+GROQ_MAX_CONCURRENCY = 8
+GROQ_SEMAPHORE = threading.BoundedSemaphore(GROQ_MAX_CONCURRENCY)
+ZIP_POOL = ThreadPoolExecutor(max_workers=GROQ_MAX_CONCURRENCY, thread_name_prefix="zip")
+# ZIP members are read into memory (one per ZIP_POOL worker), never extracted; larger ones are rejected
+MAX_ZIP_MEMBER_BYTES = 100 * 1024 * 1024
+# Chunk-group prompts of one long document run here in parallel
+GROQ_POOL = ThreadPoolExecutor(max_workers=GROQ_MAX_CONCURRENCY, thread_name_prefix="groq")
+_CACHE_LOCK = threading.Lock()
+
+# /export keeps up to this much of the generated XLSX in RAM before spilling to disk
+EXPORT_SPOOL_BYTES = 16 * 1024 * 1024
+EXPORT_CHUNK_BYTES = 64 * 1024
+
+# /records fetches rows from its server-side cursor this many at a time; largest page size
+# accepted by /records and /batches (/records returns the whole batch when no limit is given)
+RECORDS_PARTITION_ROWS = 500
+RECORDS_MAX_LIMIT = 10000
+
+# Text PyMuPDF extracts from PDFs: plain-text defaults plus joining words hyphenated across lines
+PDF_TEXT_FLAGS = fitz.TEXTFLAGS_TEXT | fitz.TEXT_DEHYPHENATE
+
+# Document text sent to Groq is cut into overlapping chunks (LLM_CHUNK_CHARS long, sharing
+# LLM_CHUNK_OVERLAP chars with the previous one), LLM_CHUNKS_PER_PROMPT chunks per request.
+# MAX_LLM_CHARS caps the text used per file.
+LLM_CHUNK_CHARS = 9000
+LLM_CHUNK_OVERLAP = 1000
+LLM_CHUNKS_PER_PROMPT = 4
+MAX_LLM_CHARS = 200000
 
 ALLOWED_EXTENSIONS = {"pdf", "xlsx", "xls", "csv", "jpg", "jpeg", "png", "zip"}
 
@@ -56,13 +127,58 @@ CRM_KEYS = [
     "expected_close_date",
 ]
 
-engine: Engine = create_engine(DATABASE_URL, pool_pre_ping=True)
+# Source column names accepted for each CRM key, in priority order (first non-empty wins)
+CRM_ALIASES = {
+    "deal_id": ("deal_id", "id", "dealid", "deal"),
+    "client_name": ("company", "client_name", "client", "account", "customer"),
+    "deal_value": ("amount", "deal_value", "value", "total", "deal_amount"),
+    "stage": ("stage", "deal_stage", "pipeline_stage"),
+    "closing_probability": (
+        "close_probability_(%)", "close_probability", "probability", "closing_probability", "closing_probability_(%)"
+    ),
+    "owner": ("owner", "deal_owner", "sales_rep", "salesperson"),
+    "expected_close_date": ("expected_close_date", "close_date", "expected_close", "forecast_close_date"),
+}
+
+# Cell values read as missing in CSV/Excel sheets (pandas' default na_values, plus empty)
+NA_VALUES = [
+    "", "#N/A", "#N/A N/A", "#NA", "-1.#IND", "-1.#QNAN", "-NaN", "-nan", "1.#IND", "1.#QNAN",
+    "<NA>", "N/A", "NA", "NULL", "NaN", "None", "n/a", "nan", "null",
+]
+
+# Reverse index of CRM_ALIASES: source column -> (CRM key, priority of that alias)
+ALIAS_TO_CRM = {alias: (key, rank) for key, aliases in CRM_ALIASES.items() for rank, alias in enumerate(aliases)}
+
+# deals columns written by insert_deals; above COPY_THRESHOLD rows they go through COPY
+DEAL_COLUMNS = ["id", "batch_id", "source_file", *CRM_KEYS]
+COPY_THRESHOLD = 1000
+
+# Sized for concurrent /upload work: every FILE_POOL / ZIP_POOL job holds a connection while
+# it writes. Recycled before Supabase's pooler drops idle connections.
+DB_POOL_SIZE = int(os.getenv("DB_POOL_SIZE", "20"))
+DB_MAX_OVERFLOW = int(os.getenv("DB_MAX_OVERFLOW", "40"))
+
+engine: Engine = create_engine(
+    DATABASE_URL,
+    pool_size=DB_POOL_SIZE,
+    max_overflow=DB_MAX_OVERFLOW,
+    pool_recycle=300,
+    pool_pre_ping=True,
+)
 
 # -----------------------------
 # DB init
 # -----------------------------
+# pg advisory lock id serializing init_db across workers/processes
+INIT_DB_LOCK_KEY = 7243001
+
 def init_db():
+    """
+    Create tables and indexes once. Runs at app startup under an advisory lock, so several
+    uvicorn workers starting together don't race on the DDL; every statement is IF NOT EXISTS.
+    """
     with engine.begin() as conn:
+        conn.execute(text("SELECT pg_advisory_xact_lock(:key)"), {"key": INIT_DB_LOCK_KEY})
         conn.execute(text("""
         CREATE TABLE IF NOT EXISTS uploads (
             id UUID PRIMARY KEY,
@@ -87,8 +203,10 @@ def init_db():
             expected_close_date TEXT NULL
         );
         """))
-
-init_db()
+        # every read path filters deals by batch_id (the leading column); /kpis also groups by stage
+        conn.execute(text("CREATE INDEX IF NOT EXISTS deals_batch_stage_idx ON deals (batch_id, stage)"))
+        # /batches groups uploads by batch_id and orders by latest upload_timestamp
+        conn.execute(text("CREATE INDEX IF NOT EXISTS uploads_batch_ts_idx ON uploads (batch_id, upload_timestamp DESC)"))
 
 # -----------------------------
 # FastAPI app
@@ -98,7 +216,13 @@ app = FastAPI(title="CRM Deal Consolidation API")
 from fastapi import FastAPI
 from fastapi.middleware.cors import CORSMiddleware
 
-app = FastAPI()
+@asynccontextmanager
+async def lifespan(app: FastAPI):
+    init_db()
+    warm_tess_pool()
+    yield
+
+app = FastAPI(lifespan=lifespan)
 
 app.add_middleware(
     CORSMiddleware,
@@ -109,9 +233,10 @@ app.add_middleware(
     allow_headers=["*"],
 )
 
-# your routes below
+# your routes below; JSON endpoints declare a return type, so FastAPI serializes their
+# results straight to JSON bytes with Pydantic
 @app.get("/")
-def root():
+def root() -> Dict[str, Any]:
     return {"message": "Hello"}
 
 
@@ -121,6 +246,10 @@ def root():
 # -----------------------------
 # Helpers
 # -----------------------------
+def utcnow() -> datetime:
+    # naive UTC for the TIMESTAMP columns (datetime.utcnow() is deprecated)
+    return datetime.now(timezone.utc).replace(tzinfo=None)
+
 def ext_of(name: str) -> str:
     parts = name.rsplit(".", 1)
     return parts[1].lower() if len(parts) == 2 else ""
@@ -129,83 +258,194 @@ def normalize_column_name(name: str) -> str:
     return name.strip().lower().replace(" ", "_")
 
 def map_to_crm_schema(row: Dict[str, Any]) -> Dict[str, Any]:
-    r = {normalize_column_name(str(k)): v for k, v in row.items()}
-
-    def pick(*keys):
-        for k in keys:
-            if k in r and r[k] not in (None, ""):
-                return r[k]
-        return None
-
-    deal_value = pick("amount", "deal_value", "value", "total", "deal_amount")
-    closing_probability = pick(
-        "close_probability_(%)", "close_probability", "probability", "closing_probability", "closing_probability_(%)"
-    )
+    """
+    One source record (a Groq deal object, or any dict keyed by column names) -> CRM dict.
+    Single pass over the row via ALIAS_TO_CRM; an exact CRM key always wins, and on other
+    alias clashes the higher-priority alias wins.
+    """
+    out = {k: None for k in CRM_KEYS}
+    ranks: Dict[str, int] = {}
+    for k, v in row.items():
+        name = normalize_column_name(str(k))
+        hit = ALIAS_TO_CRM.get(name)
+        if hit is None or v is None or v == "":
+            continue
+        key, rank = hit
+        if name == key:
+            rank = -1
+        if rank < ranks.get(key, len(CRM_ALIASES[key])):
+            out[key] = v
+            ranks[key] = rank
 
-    # normalize probability to float 0-100
-    if closing_probability is not None:
+    # normalize deal_value to float
+    if out["deal_value"] is not None:
         try:
-            closing_probability = float(str(closing_probability).replace("%", "").strip())
+            out["deal_value"] = float(str(out["deal_value"]).replace(",", "").replace("$", "").strip())
         except:
-            closing_probability = None
+            out["deal_value"] = None
+        if out["deal_value"] is not None and not math.isfinite(out["deal_value"]):
+            out["deal_value"] = None
 
-    # normalize deal_value to float
-    if deal_value is not None:
+    # normalize probability to float 0-100
+    if out["closing_probability"] is not None:
         try:
-            deal_value = float(str(deal_value).replace(",", "").strip())
+            cp = float(str(out["closing_probability"]).replace("%", "").strip())
+            # if it looks like 0-1, convert
+            if 0 <= cp <= 1:
+                cp = cp * 100.0
+            out["closing_probability"] = cp if math.isfinite(cp) else None
         except:
-            deal_value = None
-
-    out = {
-        "deal_id": pick("deal_id", "id", "dealid", "deal"),
-        "client_name": pick("company", "client_name", "client", "account", "customer"),
-        "deal_value": deal_value,
-        "stage": pick("stage", "deal_stage", "pipeline_stage"),
-        "closing_probability": closing_probability,
-        "owner": pick("owner", "deal_owner", "sales_rep", "salesperson"),
-        "expected_close_date": pick("expected_close_date", "close_date", "expected_close", "forecast_close_date"),
-    }
-    # ensure all keys exist
-    for k in CRM_KEYS:
-        out.setdefault(k, None)
+            out["closing_probability"] = None
     return out
 
-def ocr_image_path(image_path: str) -> str:
-    img = Image.open(image_path)
-    return pytesseract.image_to_string(img).strip()
+def map_frame_to_crm_schema(lf: pl.LazyFrame) -> List[Dict[str, Any]]:
+    """
+    Column-wise version of map_to_crm_schema for whole CSV/Excel sheets.
+    Aliases are coalesced in priority order (NA_VALUES cells count as missing) and numeric
+    fields coerced as polars expressions over the columns cast to text; the plan runs on the
+    streaming engine.
+    """
+    # normalized name -> first source column that normalizes to it
+    columns: Dict[str, str] = {}
+    for c in lf.collect_schema().names():
+        columns.setdefault(normalize_column_name(c), c)
+
+    def cell(name: str) -> pl.Expr:
+        c = pl.col(columns[name]).cast(pl.Utf8)
+        return pl.when(c.is_in(NA_VALUES)).then(None).otherwise(c)  # NA_VALUES cells count as missing
+
+    fields = {}
+    for key in CRM_KEYS:
+        present = [a for a in CRM_ALIASES[key] if a in columns]
+        # first non-null alias wins, left to right
+        fields[key] = pl.coalesce([cell(a) for a in present]) if present else pl.lit(None, dtype=pl.Utf8)
+
+    def finite(x: pl.Expr) -> pl.Expr:
+        # "inf" and the like parse as floats; keep only finite numbers
+        return pl.when(x.is_finite()).then(x).otherwise(None)
+
+    # normalize deal_value to float
+    fields["deal_value"] = finite(
+        fields["deal_value"].str.replace_all(r"[,$]", "").str.strip_chars().cast(pl.Float64, strict=False)
+    )
+    # normalize probability to float 0-100 (0-1 fractions are scaled up)
+    cp = finite(fields["closing_probability"].str.replace_all("%", "", literal=True).str.strip_chars().cast(pl.Float64, strict=False))
+    fields["closing_probability"] = pl.when(cp.is_between(0, 1)).then(cp * 100.0).otherwise(cp)
 
-def extract_pdf_text_or_ocr(pdf_path: str) -> str:
-    doc = fitz.open(pdf_path)
+    df = lf.select([expr.alias(key) for key, expr in fields.items()]).collect(engine="streaming")
+    return df.to_dicts()
 
-    # 1) embedded text
+def new_tess_api() -> Optional[PyTessBaseAPI]:
+    """
+    Reserve a slot in _TESS_POOL and create its Tesseract API; None once OCR_WORKERS exist.
+    Raises (and frees the slot) if the traineddata can't be loaded.
+    """
+    global _tess_created
+    with _TESS_LOCK:
+        if _tess_created >= OCR_WORKERS:
+            return None
+        _tess_created += 1
+    try:
+        kwargs = {"path": TESSDATA_DIR} if TESSDATA_DIR else {}
+        return PyTessBaseAPI(lang="eng", psm=PSM.AUTO, **kwargs)
+    except BaseException:
+        with _TESS_LOCK:
+            _tess_created -= 1
+        raise
+
+def warm_tess_pool():
+    """
+    Fill _TESS_POOL at startup. A host without Tesseract data still starts; OCR then fails
+    per file when it is actually needed, and CSV/Excel uploads and the read endpoints work.
+    """
+    try:
+        while (api := new_tess_api()) is not None:
+            _TESS_POOL.put(api)
+    except RuntimeError as e:
+        logger.warning(
+            "Tesseract could not be initialized (%s); scanned PDFs and images will fail until "
+            "Tesseract and its traineddata are installed and TESSDATA_PREFIX points at them.", e
+        )
+
+def ocr_image(img: Image.Image) -> str:
+    try:
+        api = _TESS_POOL.get_nowait()
+    except queue.Empty:
+        # pool not (fully) warmed: create an instance up to the cap, else wait for a free one
+        api = new_tess_api() or _TESS_POOL.get()
+    try:
+        api.SetImage(img)
+        return api.GetUTF8Text().strip()
+    finally:
+        api.Clear()
+        _TESS_POOL.put(api)
+
+# A file to process: a path on disk, or the raw bytes of a ZIP member
+Source = Union[str, bytes]
+
+def as_file(source: Source):
+    return io.BytesIO(source) if isinstance(source, bytes) else source
+
+def open_pdf(source: Source) -> fitz.Document:
+    return fitz.open(stream=source, filetype="pdf") if isinstance(source, bytes) else fitz.open(source)
+
+def ocr_image_file(source: Source) -> str:
+    return ocr_image(Image.open(as_file(source)))
+
+def extract_pdf_text_or_ocr(source: Source) -> str:
+    """
+    Embedded PDF text, or OCR of the pages if there is hardly any. Either way at most
+    MAX_LLM_CHARS are produced: pages past that budget are never parsed or OCR'd.
+    """
+    # 1) embedded text, one textpage per page
     embedded = []
-    for page in doc:
-        t = page.get_text("text").strip()
-        if t:
-            embedded.append(t)
+    total = 0
+    with open_pdf(source) as doc:
+        page_count = len(doc)
+        for page in doc:
+            t = page.get_textpage(flags=PDF_TEXT_FLAGS).extractText().strip()
+            if t:
+                embedded.append(t[: MAX_LLM_CHARS - total])
+                total += len(embedded[-1]) + 2
+                if total >= MAX_LLM_CHARS:
+                    break
     embedded_text = "\n\n".join(embedded).strip()
     if len(embedded_text) >= 200:
         return embedded_text
 
-    # 2) OCR pages (scanned)
+    # 2) OCR pages (scanned) in parallel on OCR_POOL, in page order, keeping only a small
+    # window of pages in flight so the remaining pages can be skipped once the budget is hit
+    pages = iter(range(page_count))
+    pending = deque(OCR_POOL.submit(_ocr_page, i, source) for i in islice(pages, OCR_WINDOW))
     ocr_chunks = []
-    for i in range(len(doc)):
-        page = doc.load_page(i)
-        pix = page.get_pixmap(dpi=200)
-        tmp_img = os.path.join(TMP_DIR, f"{uuid.uuid4()}_p{i}.png")
-        pix.save(tmp_img)
-        try:
-            ocr_chunks.append(ocr_image_path(tmp_img))
-        finally:
-            if os.path.exists(tmp_img):
-                os.remove(tmp_img)
-    return "\n\n".join([c for c in ocr_chunks if c]).strip()
+    total = 0
+    while pending:
+        c = pending.popleft().result()
+        nxt = next(pages, None)
+        if nxt is not None:
+            pending.append(OCR_POOL.submit(_ocr_page, nxt, source))
+        if c:
+            ocr_chunks.append(c[: MAX_LLM_CHARS - total])
+            total += len(ocr_chunks[-1]) + 2
+            if total >= MAX_LLM_CHARS:
+                for f in pending:
+                    f.cancel()
+                break
+    return "\n\n".join(ocr_chunks).strip()
+
+def _ocr_page(page_index: int, source: Source) -> str:
+    # PyMuPDF documents are not thread-safe, so every worker opens its own handle
+    with open_pdf(source) as doc:
+        pix = doc.load_page(page_index).get_pixmap(dpi=OCR_DPI, colorspace=fitz.csGRAY)
+    # feed the raw 8-bit gray pixmap straight to Tesseract (no PNG roundtrip through disk)
+    img = Image.frombuffer("L", (pix.width, pix.height), pix.samples, "raw", "L", 0, 1)
+    return ocr_image(img)
 
 
 def safe_json_loads(text_: str) -> dict:
     """
     Attempts to parse JSON even if model adds extra text.
-    1) direct json.loads
+    1) direct orjson.loads
     2) extract first {...} block and parse
     """
     if not text_ or not text_.strip():
@@ -213,8 +453,8 @@ def safe_json_loads(text_: str) -> dict:
 
     s = text_.strip()
     try:
-        return json.loads(s)
-    except Exception:
+        return orjson.loads(s)
+    except orjson.JSONDecodeError:
         pass
 
     # try to salvage: find first { and last }
@@ -222,33 +462,30 @@ def safe_json_loads(text_: str) -> dict:
     end = s.rfind("}")
     if start != -1 and end != -1 and end > start:
         candidate = s[start : end + 1]
-        return json.loads(candidate)
+        return orjson.loads(candidate)
 
     # give a helpful error for debugging
     raise ValueError(f"Groq returned non-JSON. First 200 chars: {s[:200]!r}")
 
-def groq_extract_deals(raw_text: str, source_hint: str) -> List[Dict[str, Any]]:
-    """
-    Groq LLM: raw text -> strict JSON list of CRM deals.
-    Required by doc: Groq Cloud LLMs, normalize field names, strict JSON. :contentReference[oaicite:14]{index=14}
-    """
-    schema_desc = {
-        "deal_id": "string or null",
-        "client_name": "string or null",
-        "deal_value": "number or null",
-        "stage": "string or null",
-        "closing_probability": "number (0-100) or null",
-        "owner": "string or null",
-        "expected_close_date": "string (YYYY-MM-DD preferred) or null"
-    }
-
-    prompt = f"""
+# Static parts of the extraction prompt, built once at import; only the source hint
+# and the document text change per call.
+GROQ_SCHEMA_DESC = {
+    "deal_id": "string or null",
+    "client_name": "string or null",
+    "deal_value": "number or null",
+    "stage": "string or null",
+    "closing_probability": "number (0-100) or null",
+    "owner": "string or null",
+    "expected_close_date": "string (YYYY-MM-DD preferred) or null"
+}
+
+_PROMPT_HEAD = f"""
 You are a data extraction engine for CRM deal documents.
-Extract CRM deals from the provided text and return ONLY valid JSON.
+Extract CRM deals from each of the provided text chunks and return ONLY valid JSON.
 
-Return a JSON object with this shape:
+Return a JSON object with this shape, one entry per chunk, in chunk order:
 {{
-  "deals": [ {{...}}, {{...}} ]
+  "chunks": [ {{"deals": [ {{...}}, {{...}} ]}}, ... ]
 }}
 
 Rules:
@@ -259,185 +496,321 @@ Rules:
 - deal_value must be numeric (remove commas/currency symbols).
 - Normalize field names from messy sources.
 - Do NOT invent deals not present.
+- Chunks are consecutive, slightly overlapping windows of one document.
 
-Source type hint: {source_hint}
+Source type hint: """
 
-Schema:
-{json.dumps(schema_desc, indent=2)}
+_PROMPT_SCHEMA = f"""
 
-TEXT:
-\"\"\"{raw_text[:12000]}\"\"\"
+Schema:
+{json.dumps(GROQ_SCHEMA_DESC, indent=2)}
 """
-    # Use a fast, capable Groq model; you can change later if needed.
-    resp = client.chat.completions.create(
-    model="llama-3.3-70b-versatile",
-    messages=[
-        {"role": "system", "content": "You are a data extraction engine. Output ONLY a valid JSON object. No prose."},
-        {"role": "user", "content": prompt},
-    ],
-    temperature=0,
-    response_format={"type": "json_object"},
+
+def split_text_chunks(raw_text: str) -> List[str]:
+    """
+    Overlapping LLM_CHUNK_CHARS windows over the first MAX_LLM_CHARS of text, so a deal
+    cut at one window's edge is still whole in the next.
+    """
+    text_ = raw_text[:MAX_LLM_CHARS]
+    if len(text_) <= LLM_CHUNK_CHARS:
+        return [text_]
+    step = LLM_CHUNK_CHARS - LLM_CHUNK_OVERLAP
+    return [text_[i : i + LLM_CHUNK_CHARS] for i in range(0, len(text_) - LLM_CHUNK_OVERLAP, step)]
+
+def groq_extract_chunk_group(chunks: List[str], source_hint: str) -> List[Dict[str, Any]]:
+    """
+    One Groq request for up to LLM_CHUNKS_PER_PROMPT chunks; returns the raw deal dicts of all of them.
+    """
+    prompt = _PROMPT_HEAD + source_hint + _PROMPT_SCHEMA + "".join(
+        f'\nCHUNK {i} of {len(chunks)}:\n"""{c}"""\n' for i, c in enumerate(chunks, start=1)
     )
+    # Use a fast, capable Groq model; you can change later if needed.
+    with GROQ_SEMAPHORE:
+        resp = client.chat.completions.create(
+        model="llama-3.3-70b-versatile",
+        messages=[
+            {"role": "system", "content": "You are a data extraction engine. Output ONLY a valid JSON object. No prose."},
+            {"role": "user", "content": prompt},
+        ],
+        temperature=0,
+        response_format={"type": "json_object"},
+        )
 
     content = (resp.choices[0].message.content or "").strip()
     data = safe_json_loads(content)
-    deals = data.get("deals", [])
-    cleaned = []
-    for d in deals:
-        item = {k: d.get(k, None) for k in CRM_KEYS}
-        # coerce numeric fields
-        if item["deal_value"] is not None:
-            try:
-                item["deal_value"] = float(str(item["deal_value"]).replace(",", "").replace("$", "").strip())
-            except:
-                item["deal_value"] = None
-        if item["closing_probability"] is not None:
-            try:
-                cp = float(str(item["closing_probability"]).replace("%", "").strip())
-                # if it looks like 0-1, convert
-                if 0 <= cp <= 1:
-                    cp = cp * 100.0
-                item["closing_probability"] = cp
-            except:
-                item["closing_probability"] = None
-        cleaned.append(item)
-    return cleaned
-
-def save_upload_row(upload_id, batch_id, source_file, ts, status, error=None):
-    with engine.begin() as conn:
-        conn.execute(
-            text("""
-            INSERT INTO uploads (id, batch_id, source_file, upload_timestamp, processing_status, error)
-            VALUES (:id, :batch_id, :source_file, :ts, :status, :error)
-            """),
-            {"id": str(upload_id), "batch_id": str(batch_id), "source_file": source_file, "ts": ts, "status": status, "error": error},
-        )
+    if "chunks" not in data:
+        # model answered in the flat {"deals": [...]} shape
+        return data.get("deals", [])
+    return [d for c in data["chunks"] if isinstance(c, dict) for d in c.get("deals", [])]
 
-def save_deals(batch_id, source_file, deals: List[Dict[str, Any]]):
-    with engine.begin() as conn:
-        for d in deals:
-            conn.execute(
-                text("""
-                INSERT INTO deals (id, batch_id, source_file, deal_id, client_name, deal_value, stage,
-                                   closing_probability, owner, expected_close_date)
-                VALUES (:id, :batch_id, :source_file, :deal_id, :client_name, :deal_value, :stage,
-                        :closing_probability, :owner, :expected_close_date)
-                """),
-                {
-                    "id": str(uuid.uuid4()),
-                    "batch_id": str(batch_id),
-                    "source_file": source_file,
-                    "deal_id": d.get("deal_id"),
-                    "client_name": d.get("client_name"),
-                    "deal_value": d.get("deal_value"),
-                    "stage": d.get("stage"),
-                    "closing_probability": d.get("closing_probability"),
-                    "owner": d.get("owner"),
-                    "expected_close_date": d.get("expected_close_date"),
-                },
-            )
+def groq_extract_deals(raw_text: str, source_hint: str) -> List[Dict[str, Any]]:
+    """
+    Groq LLM: raw text -> strict JSON list of CRM deals.
+    Required by doc: Groq Cloud LLMs, normalize field names, strict JSON. :contentReference[oaicite:14]{index=14}
+    Long text is split into overlapping chunks, batched several per prompt (prompts run in
+    parallel on GROQ_POOL); when there are several chunks, deals seen in two overlapping
+    chunks are kept once.
+    """
+    chunks = split_text_chunks(raw_text)
+    groups = [chunks[i : i + LLM_CHUNKS_PER_PROMPT] for i in range(0, len(chunks), LLM_CHUNKS_PER_PROMPT)]
+    if len(groups) == 1:
+        deals = groq_extract_chunk_group(groups[0], source_hint)
+    else:
+        deals = list(chain.from_iterable(GROQ_POOL.map(groq_extract_chunk_group, groups, repeat(source_hint))))
+
+    cleaned = [map_to_crm_schema(d) for d in deals if isinstance(d, dict)]
+    if len(chunks) == 1:
+        return cleaned
+
+    # overlap duplicates: same (deal_id, client_name) when deal_id is present, otherwise only
+    # an identical record (distinct deals without an ID for the same client are all kept)
+    unique = []
+    seen = set()
+    for item in cleaned:
+        if item["deal_id"] is not None:
+            key = ("id", item["deal_id"], item["client_name"])
+        else:
+            key = ("record", *(str(item[k]) for k in CRM_KEYS))
+        if key in seen:
+            continue
+        seen.add(key)
+        unique.append(item)
+    return unique
+
+def insert_upload_row(conn, upload_id, batch_id, source_file, ts, status, error=None):
+    conn.execute(
+        text("""
+        INSERT INTO uploads (id, batch_id, source_file, upload_timestamp, processing_status, error)
+        VALUES (:id, :batch_id, :source_file, :ts, :status, :error)
+        """),
+        {"id": str(upload_id), "batch_id": str(batch_id), "source_file": source_file, "ts": ts, "status": status, "error": error},
+    )
 
-def parse_csv(file_path: str) -> List[Dict[str, Any]]:
-    df = pd.read_csv(file_path)
-    df = df.where(pd.notnull(df), None)
-    return [map_to_crm_schema(row) for row in df.to_dict(orient="records")]
+def insert_deals(conn, batch_id, source_file, deals: List[Dict[str, Any]]):
+    """
+    Insert a file's deals on the caller's connection/transaction.
+    """
+    if not deals:
+        return
+    rows = [
+        {
+            "id": str(uuid.uuid4()),
+            "batch_id": str(batch_id),
+            "source_file": source_file,
+            **{k: d.get(k) for k in CRM_KEYS},
+        }
+        for d in deals
+    ]
+    if len(rows) > COPY_THRESHOLD:
+        # large sheets: stream one CSV through COPY instead of binding every row
+        buf = io.StringIO()
+        csv.DictWriter(buf, fieldnames=DEAL_COLUMNS).writerows(rows)
+        buf.seek(0)
+        cur = conn.connection.cursor()
+        try:
+            cur.copy_expert(f"COPY deals ({', '.join(DEAL_COLUMNS)}) FROM STDIN WITH CSV", buf)
+        finally:
+            cur.close()
+        return
+    # one executemany round-trip for the whole list
+    conn.execute(
+        text("""
+        INSERT INTO deals (id, batch_id, source_file, deal_id, client_name, deal_value, stage,
+                           closing_probability, owner, expected_close_date)
+        VALUES (:id, :batch_id, :source_file, :deal_id, :client_name, :deal_value, :stage,
+                :closing_probability, :owner, :expected_close_date)
+        """),
+        rows,
+    )
+
+def parse_csv(source: Source) -> List[Dict[str, Any]]:
+    # lazy scan, every column read as text; typing happens in map_frame_to_crm_schema
+    return map_frame_to_crm_schema(pl.scan_csv(source, infer_schema=False))
+
+def parse_excel(source: Source) -> List[Dict[str, Any]]:
+    # calamine (fastexcel) reads both .xlsx and .xls; every column read as text, like parse_csv,
+    # so cells that don't match a column's leading type are kept rather than nulled
+    return map_frame_to_crm_schema(pl.read_excel(source, engine="calamine", infer_schema_length=0).lazy())
+
+def sha256_source(source: Source) -> bytes:
+    if isinstance(source, bytes):
+        return hashlib.sha256(source).digest()
+    h = hashlib.sha256()
+    with open(source, "rb") as f:
+        for block in iter(lambda: f.read(1 << 20), b""):
+            h.update(block)
+    return h.digest()
+
+def cached_call(cache: Optional[Dict[bytes, Future]], key: bytes, compute):
+    """
+    compute() at most once per key. The cache holds Futures, so concurrent callers with
+    the same key wait for the first one instead of repeating the work.
+    """
+    if cache is None:
+        return compute()
+    with _CACHE_LOCK:
+        fut = cache.get(key)
+        owner = fut is None
+        if owner:
+            fut = cache[key] = Future()
+    if owner:
+        try:
+            fut.set_result(compute())
+        except BaseException as e:
+            fut.set_exception(e)
+            raise
+    return fut.result()
 
-def parse_excel(file_path: str) -> List[Dict[str, Any]]:
-    df = pd.read_excel(file_path)
-    df = df.where(pd.notnull(df), None)
-    return [map_to_crm_schema(row) for row in df.to_dict(orient="records")]
+def extract_text_cached(source: Source, extract, cache: Optional[Dict[bytes, Future]]) -> str:
+    """
+    Run an OCR/text extractor once per distinct file content (keyed by sha256 of the bytes).
+    """
+    key = sha256_source(source) if cache is not None else b""
+    return cached_call(cache, key, lambda: extract(source))
 
-def process_single_file(batch_id: uuid.UUID, file_path: str, original_name: str) -> Dict[str, Any]:
+def groq_extract_deals_cached(raw_text: str, source_hint: str, cache: Optional[Dict[bytes, Future]]) -> List[Dict[str, Any]]:
+    """
+    groq_extract_deals, but only one Groq call per distinct (source_hint, text) pair.
+    """
+    key = hashlib.sha256(f"{source_hint}\0{raw_text}".encode("utf-8")).digest() if cache is not None else b""
+    return cached_call(cache, key, lambda: groq_extract_deals(raw_text, source_hint))
+
+def record_failed_file(batch_id: uuid.UUID, source_file: str, exc: BaseException, upload_id=None, ts=None) -> Dict[str, Any]:
+    """
+    Record a file that could not be processed as a 'failed' upload row; returns its result.
+    """
+    err = str(exc)
+    with engine.begin() as conn:
+        insert_upload_row(conn, upload_id or uuid.uuid4(), batch_id, source_file, ts or utcnow(), "failed", err)
+    return {"source_file": source_file, "processing_status": "failed", "error": err}
+
+def process_single_file(
+    batch_id: uuid.UUID,
+    source: Source,
+    original_name: str,
+    ocr_cache: Optional[Dict[bytes, Future]] = None,
+    llm_cache: Optional[Dict[bytes, Future]] = None,
+) -> Dict[str, Any]:
     """
     Orchestrator for ONE file (CSV / XLSX / PDF / Image).
-    ZIP is handled separately and calls this for each extracted file.
+    ZIP is handled separately and calls this with the bytes of each contained file.
+    ocr_cache / llm_cache let a caller skip repeat OCR and Groq work for duplicate files.
     """
-    ts = datetime.utcnow()
+    ts = utcnow()
     upload_id = uuid.uuid4()
     ext = ext_of(original_name)
-
-    save_upload_row(upload_id, batch_id, original_name, ts, "uploaded")
+    raw_text = None
 
     try:
         if ext == "csv":
-            deals = parse_csv(file_path)
-            save_deals(batch_id, original_name, deals)
-            # Update status
-            with engine.begin() as conn:
-                conn.execute(text("UPDATE uploads SET processing_status='parsed' WHERE id=:id"), {"id": str(upload_id)})
-            return {"source_file": original_name, "processing_status": "parsed", "records_count": len(deals), "records_preview": deals[:3]}
-
-        if ext in {"xlsx", "xls"}:
-            deals = parse_excel(file_path)
-            save_deals(batch_id, original_name, deals)
-            with engine.begin() as conn:
-                conn.execute(text("UPDATE uploads SET processing_status='parsed' WHERE id=:id"), {"id": str(upload_id)})
-            return {"source_file": original_name, "processing_status": "parsed", "records_count": len(deals), "records_preview": deals[:3]}
-
-        if ext in {"jpg", "jpeg", "png"}:
-            raw_text = ocr_image_path(file_path)
-            deals = groq_extract_deals(raw_text, source_hint="scanned_image_contract")
-            save_deals(batch_id, original_name, deals)
-            with engine.begin() as conn:
-                conn.execute(text("UPDATE uploads SET processing_status='ai_extracted' WHERE id=:id"), {"id": str(upload_id)})
-            return {"source_file": original_name, "processing_status": "ai_extracted", "records_count": len(deals), "text_preview": raw_text[:400], "records_preview": deals[:3]}
-
-        if ext == "pdf":
-            raw_text = extract_pdf_text_or_ocr(file_path)
-            deals = groq_extract_deals(raw_text, source_hint="pdf_report_or_contract")
-            save_deals(batch_id, original_name, deals)
+            deals = parse_csv(source)
+            status = "parsed"
+        elif ext in {"xlsx", "xls"}:
+            deals = parse_excel(source)
+            status = "parsed"
+        elif ext in {"jpg", "jpeg", "png"}:
+            raw_text = extract_text_cached(source, ocr_image_file, ocr_cache)
+            deals = groq_extract_deals_cached(raw_text, "scanned_image_contract", llm_cache)
+            status = "ai_extracted"
+        elif ext == "pdf":
+            raw_text = extract_text_cached(source, extract_pdf_text_or_ocr, ocr_cache)
+            deals = groq_extract_deals_cached(raw_text, "pdf_report_or_contract", llm_cache)
+            status = "ai_extracted"
+        else:
+            # Unsupported
             with engine.begin() as conn:
-                conn.execute(text("UPDATE uploads SET processing_status='ai_extracted' WHERE id=:id"), {"id": str(upload_id)})
-            return {"source_file": original_name, "processing_status": "ai_extracted", "records_count": len(deals), "text_preview": raw_text[:400], "records_preview": deals[:3]}
+                insert_upload_row(conn, upload_id, batch_id, original_name, ts, "rejected")
+            return {"source_file": original_name, "processing_status": "rejected", "error": f"Unsupported file type: .{ext}"}
 
-        # Unsupported
+        # one transaction per file: the upload row (in its final status) plus its deals
         with engine.begin() as conn:
-            conn.execute(text("UPDATE uploads SET processing_status='rejected' WHERE id=:id"), {"id": str(upload_id)})
-        return {"source_file": original_name, "processing_status": "rejected", "error": f"Unsupported file type: .{ext}"}
+            insert_upload_row(conn, upload_id, batch_id, original_name, ts, status)
+            insert_deals(conn, batch_id, original_name, deals)
 
     except Exception as e:
-        err = str(e)
-        with engine.begin() as conn:
-            conn.execute(text("UPDATE uploads SET processing_status='failed', error=:err WHERE id=:id"), {"id": str(upload_id), "err": err})
-        return {"source_file": original_name, "processing_status": "failed", "error": err}
+        return record_failed_file(batch_id, original_name, e, upload_id, ts)
+
+    result = {"source_file": original_name, "processing_status": status, "records_count": len(deals)}
+    if raw_text is not None:
+        result["text_preview"] = raw_text[:400]
+    result["records_preview"] = deals[:3]
+    return result
 
 def process_zip(batch_id: uuid.UUID, zip_path: str, zip_name: str) -> List[Dict[str, Any]]:
     """
-    Extract ZIP safely, process each allowed file inside.
+    Process each allowed file inside a ZIP, straight from the archive (nothing is extracted
+    to disk; members over MAX_ZIP_MEMBER_BYTES are rejected).
+    Contained files are processed concurrently on ZIP_POOL (Groq calls capped by
+    GROQ_SEMAPHORE); duplicate images/PDFs are OCR'd and sent to Groq only once.
     """
+    ocr_cache: Dict[bytes, Future] = {}
+    llm_cache: Dict[bytes, Future] = {}
+    jobs = []  # per member: (file name, a ZIP_POOL future or a ready result for rejected members)
+    with zipfile.ZipFile(zip_path, "r") as z:
+        for member in z.infolist():
+            # basic safety: no absolute paths / traversal
+            if member.is_dir() or member.filename.startswith("/") or ".." in member.filename.replace("\\", "/"):
+                continue
+            fn = os.path.basename(member.filename)
+            ext = ext_of(fn)
+            if ext not in ALLOWED_EXTENSIONS or ext == "zip":
+                continue
+            if member.file_size > MAX_ZIP_MEMBER_BYTES:
+                jobs.append((fn, {"source_file": fn, "processing_status": "rejected", "error": "File too large"}))
+                continue
+            jobs.append((fn, ZIP_POOL.submit(process_zip_member, z, member, batch_id, fn, ocr_cache, llm_cache)))
+        # ZipFile reads are thread-safe; keep it open until every member is done, even if one raised
+        wait([job for _, job in jobs if isinstance(job, Future)])
+
     results = []
-    extract_dir = os.path.join(TMP_DIR, f"zip_{uuid.uuid4()}")
-    os.makedirs(extract_dir, exist_ok=True)
+    for fn, job in jobs:
+        if isinstance(job, Future):
+            exc = job.exception()
+            job = {"source_file": fn, "processing_status": "failed", "error": str(exc)} if exc else job.result()
+        results.append(job)
+    return results
+
+def process_zip_member(
+    z: zipfile.ZipFile,
+    member: zipfile.ZipInfo,
+    batch_id: uuid.UUID,
+    name: str,
+    ocr_cache: Dict[bytes, Future],
+    llm_cache: Dict[bytes, Future],
+) -> Dict[str, Any]:
+    # a member that can't be read (bad CRC, encrypted, unsupported compression) fails on its own
     try:
-        with zipfile.ZipFile(zip_path, "r") as z:
-            for member in z.infolist():
-                # basic safety: no absolute paths / traversal
-                if member.filename.startswith("/") or ".." in member.filename.replace("\\", "/"):
-                    continue
-                z.extract(member, extract_dir)
+        data = z.read(member)
+    except Exception as e:
+        return record_failed_file(batch_id, name, e)
+    return process_single_file(batch_id, data, name, ocr_cache, llm_cache)
 
-        # walk extracted files
-        for root, _, files in os.walk(extract_dir):
-            for fn in files:
-                ext = ext_of(fn)
-                if ext not in ALLOWED_EXTENSIONS or ext == "zip":
-                    continue
-                full = os.path.join(root, fn)
-                results.append(process_single_file(batch_id, full, fn))
-        return results
-    finally:
-        shutil.rmtree(extract_dir, ignore_errors=True)
+def process_uploaded_zip(batch_id: uuid.UUID, zip_path: str, zip_name: str, ts: datetime) -> Dict[str, Any]:
+    """
+    Expand a ZIP, then record the ZIP itself as an upload (expanded, or failed if unreadable).
+    """
+    zip_upload_id = uuid.uuid4()
+    try:
+        zip_results = process_zip(batch_id, zip_path, zip_name)
+    except Exception as e:
+        err = str(e)
+        with engine.begin() as conn:
+            insert_upload_row(conn, zip_upload_id, batch_id, zip_name, ts, "failed", err)
+        return {"source_file": zip_name, "processing_status": "failed", "error": err}
+    with engine.begin() as conn:
+        insert_upload_row(conn, zip_upload_id, batch_id, zip_name, ts, "expanded")
+    return {"source_file": zip_name, "processing_status": "expanded", "children": zip_results}
 
 # -----------------------------
 # API
 # -----------------------------
 @app.get("/health")
-def health():
+def health() -> Dict[str, Any]:
     return {"status": "ok"}
 
 @app.post("/upload")
 
-async def upload(files: List[UploadFile] = File(..., description="Upload one or more files")):    
+async def upload(files: List[UploadFile] = File(..., description="Upload one or more files")) -> Dict[str, Any]:
     """
     Accept multiple files (including ZIP). Orchestrate processing for:
     - CSV: deterministic parse
@@ -447,9 +820,11 @@ async def upload(files: List[UploadFile] = File(..., description="Upload one or
     - ZIP: extract and process contained files
     """
     batch_id = uuid.uuid4()
-    ts = datetime.utcnow()
+    ts = utcnow()
 
-    all_results = []
+    loop = asyncio.get_running_loop()
+    all_results: List[Optional[Dict[str, Any]]] = []
+    jobs = []  # (slot in all_results, file name, executor future)
     for f in files:
         name = f.filename
         ext = ext_of(name)
@@ -457,21 +832,26 @@ async def upload(files: List[UploadFile] = File(..., description="Upload one or
             all_results.append({"source_file": name, "processing_status": "rejected", "error": "Unsupported file type"})
             continue
 
-        saved_path = os.path.join(UPLOAD_DIR, f"{batch_id}_{name}")
-        content = await f.read()
-        with open(saved_path, "wb") as out:
-            out.write(content)
+        # stream to disk in chunks so large ZIPs are never fully buffered in memory; the slot
+        # index keeps same-named files apart while earlier ones are still being processed
+        saved_path = os.path.join(UPLOAD_DIR, f"{batch_id}_{len(all_results)}_{os.path.basename(name)}")
+        async with aiofiles.open(saved_path, "wb") as out:
+            while chunk := await f.read(UPLOAD_CHUNK_BYTES):
+                await out.write(chunk)
 
+        # files are processed concurrently on FILE_POOL while the remaining uploads are read
         if ext == "zip":
-            # record upload row for zip itself
-            zip_upload_id = uuid.uuid4()
-            save_upload_row(zip_upload_id, batch_id, name, ts, "uploaded")
-            zip_results = process_zip(batch_id, saved_path, name)
-            with engine.begin() as conn:
-                conn.execute(text("UPDATE uploads SET processing_status='expanded' WHERE id=:id"), {"id": str(zip_upload_id)})
-            all_results.append({"source_file": name, "processing_status": "expanded", "children": zip_results})
+            job = loop.run_in_executor(FILE_POOL, process_uploaded_zip, batch_id, saved_path, name, ts)
         else:
-            all_results.append(process_single_file(batch_id, saved_path, name))
+            job = loop.run_in_executor(FILE_POOL, process_single_file, batch_id, saved_path, name)
+        jobs.append((len(all_results), name, job))
+        all_results.append(None)
+
+    outcomes = await asyncio.gather(*(job for _, _, job in jobs), return_exceptions=True)
+    for (slot, name, _), outcome in zip(jobs, outcomes):
+        if isinstance(outcome, Exception):
+            outcome = {"source_file": name, "processing_status": "failed", "error": str(outcome)}
+        all_results[slot] = outcome
 
     # consolidated preview from DB (first 10)
     with engine.begin() as conn:
@@ -488,102 +868,137 @@ async def upload(files: List[UploadFile] = File(..., description="Upload one or
         "batch_id": str(batch_id),
         "message": "Processed files",
         "files": all_results,
-        "deals_preview": list(rows),
+        "deals_preview": [dict(r) for r in rows],
         "upload_timestamp": ts.isoformat()
     }
 
 @app.get("/records")
-def records(batch_id: str):
-    with engine.begin() as conn:
-        rows = conn.execute(
+def records(
+    batch_id: str,
+    limit: Optional[int] = Query(None, ge=1, le=RECORDS_MAX_LIMIT),
+    offset: int = Query(0, ge=0),
+):
+    """
+    All of a batch's deals, or one page of them when limit (and offset) is given. Rows come
+    off a server-side cursor in partitions and are written out as JSON as they arrive, so
+    memory stays flat. The query runs and its first partition is fetched before the
+    response starts, so a failing query is still a proper error response.
+    """
+    conn = engine.connect()
+    try:
+        result = conn.execution_options(stream_results=True).execute(
             text("""
             SELECT deal_id, client_name, deal_value, stage, closing_probability, owner, expected_close_date, source_file
             FROM deals
             WHERE batch_id=:batch_id
-            ORDER BY source_file
+            ORDER BY source_file, id
+            LIMIT :limit OFFSET :offset
             """),
-            {"batch_id": batch_id}
-        ).mappings().all()
-    return {"batch_id": batch_id, "records": list(rows), "count": len(rows)}
+            {"batch_id": batch_id, "limit": limit, "offset": offset}  # LIMIT NULL = no limit
+        )
+        parts = result.mappings().partitions(RECORDS_PARTITION_ROWS)
+        first = next(parts, [])
+    except BaseException:
+        conn.close()
+        raise
+
+    def gen():
+        try:
+            yield b'{"batch_id":' + orjson.dumps(batch_id) + b',"records":['
+            count = 0
+            for part in chain([first], parts):
+                if not part:
+                    continue
+                chunk = b",".join(orjson.dumps(dict(r)) for r in part)
+                yield (b"," if count else b"") + chunk
+                count += len(part)
+            yield b'],"count":' + orjson.dumps(count) + b',"limit":' + orjson.dumps(limit) + b',"offset":' + orjson.dumps(offset) + b"}"
+        finally:
+            conn.close()
+
+    return StreamingResponse(gen(), media_type="application/json")
 
 @app.get("/kpis")
-def kpis(batch_id: str):
+def kpis(batch_id: str) -> Dict[str, Any]:
     """
     Optional KPI dashboard for a batch_id.
     Computes summary metrics from the deals table.
     """
+    params = {"batch_id": batch_id}
     with engine.begin() as conn:
-        rows = conn.execute(
+        totals = conn.execute(
             text("""
-            SELECT deal_id, client_name, deal_value, stage, closing_probability, owner, expected_close_date, source_file
+            SELECT COUNT(*) AS total_deals,
+                   COALESCE(SUM(deal_value), 0) AS total_value,
+                   AVG(closing_probability) AS avg_probability
             FROM deals
             WHERE batch_id=:batch_id
             """),
-            {"batch_id": batch_id}
+            params
+        ).mappings().one()
+
+        if not totals["total_deals"]:
+            return {
+                "batch_id": batch_id,
+                "total_deals": 0,
+                "total_value": 0,
+                "avg_probability": None,
+                "value_by_stage": [],
+                "deals_by_owner": [],
+                "value_by_month": [],
+            }
+
+        # value by stage
+        stage_rows = conn.execute(
+            text("""
+            SELECT COALESCE(NULLIF(stage, ''), 'Unknown') AS stage, SUM(COALESCE(deal_value, 0)) AS value
+            FROM deals
+            WHERE batch_id=:batch_id
+            GROUP BY 1
+            ORDER BY value DESC
+            """),
+            params
         ).mappings().all()
 
-    data = list(rows)
-    if not data:
-        return {
-            "batch_id": batch_id,
-            "total_deals": 0,
-            "total_value": 0,
-            "avg_probability": None,
-            "value_by_stage": [],
-            "deals_by_owner": [],
-            "value_by_month": [],
-        }
+        # deals by owner
+        owner_rows = conn.execute(
+            text("""
+            SELECT COALESCE(NULLIF(owner, ''), 'Unknown') AS owner, COUNT(*) AS count
+            FROM deals
+            WHERE batch_id=:batch_id
+            GROUP BY 1
+            ORDER BY count DESC
+            """),
+            params
+        ).mappings().all()
 
-    # helpers
-    def safe_float(x):
-        try:
-            if x is None or x == "":
-                return None
-            return float(x)
-        except:
-            return None
+        # value by expected close month (YYYY-MM); supports YYYY-MM-DD or YYYY-MM, Unknown last
+        month_rows = conn.execute(
+            text("""
+            SELECT month, SUM(value) AS value
+            FROM (
+                SELECT CASE
+                         WHEN SUBSTRING(TRIM(expected_close_date) FROM 5 FOR 1) = '-'
+                              AND LENGTH(TRIM(expected_close_date)) >= 7
+                         THEN SUBSTRING(TRIM(expected_close_date) FROM 1 FOR 7)
+                         ELSE 'Unknown'
+                       END AS month,
+                       COALESCE(deal_value, 0) AS value
+                FROM deals
+                WHERE batch_id=:batch_id
+            ) m
+            GROUP BY month
+            ORDER BY month = 'Unknown', month
+            """),
+            params
+        ).mappings().all()
 
-    total_deals = len(data)
-    values = [safe_float(r.get("deal_value")) for r in data]
-    probs = [safe_float(r.get("closing_probability")) for r in data]
-
-    total_value = sum([v for v in values if v is not None])
-
-    prob_valid = [p for p in probs if p is not None]
-    avg_probability = (sum(prob_valid) / len(prob_valid)) if prob_valid else None
-
-    # value by stage
-    stage_map = {}
-    for r in data:
-        stage = r.get("stage") or "Unknown"
-        v = safe_float(r.get("deal_value")) or 0.0
-        stage_map[stage] = stage_map.get(stage, 0.0) + v
-    value_by_stage = [{"stage": k, "value": round(v, 2)} for k, v in stage_map.items()]
-    value_by_stage.sort(key=lambda x: x["value"], reverse=True)
-
-    # deals by owner
-    owner_map = {}
-    for r in data:
-        owner = r.get("owner") or "Unknown"
-        owner_map[owner] = owner_map.get(owner, 0) + 1
-    deals_by_owner = [{"owner": k, "count": v} for k, v in owner_map.items()]
-    deals_by_owner.sort(key=lambda x: x["count"], reverse=True)
-
-    # value by expected close month (YYYY-MM)
-    month_map = {}
-    for r in data:
-        d = (r.get("expected_close_date") or "").strip()
-        # supports YYYY-MM-DD or YYYY-MM
-        month = None
-        if len(d) >= 7 and d[4] == "-":
-            month = d[:7]
-        if not month:
-            month = "Unknown"
-        v = safe_float(r.get("deal_value")) or 0.0
-        month_map[month] = month_map.get(month, 0.0) + v
-    value_by_month = [{"month": k, "value": round(v, 2)} for k, v in month_map.items()]
-    # put Unknown last
-    value_by_month.sort(key=lambda x: (x["month"] == "Unknown", x["month"]))
+    total_deals = totals["total_deals"]
+    total_value = float(totals["total_value"])
+    avg_probability = totals["avg_probability"]
+    value_by_stage = [{"stage": r["stage"], "value": round(r["value"], 2)} for r in stage_rows]
+    deals_by_owner = [{"owner": r["owner"], "count": r["count"]} for r in owner_rows]
+    value_by_month = [{"month": r["month"], "value": round(r["value"], 2)} for r in month_rows]
 
     return {
         "batch_id": batch_id,
@@ -596,9 +1011,9 @@ def kpis(batch_id: str):
     }
 
 @app.get("/batches")
-def batches(limit: int = 20):
+def batches(limit: int = Query(20, ge=1, le=RECORDS_MAX_LIMIT), offset: int = Query(0, ge=0)) -> Dict[str, Any]:
     """
-    Returns recent batch_ids from uploads table, newest first.
+    Returns recent batch_ids from uploads table, newest first (paged with limit/offset).
     Includes upload_timestamp and file count.
     """
     with engine.begin() as conn:
@@ -611,34 +1026,55 @@ def batches(limit: int = 20):
             FROM uploads
             GROUP BY batch_id
             ORDER BY latest_upload DESC
-            LIMIT :limit
+            LIMIT :limit OFFSET :offset
             """),
-            {"limit": limit}
+            {"limit": limit, "offset": offset}
         ).mappings().all()
 
     return {"batches": [dict(r) for r in rows], "count": len(rows)}
 
 @app.get("/export")
 def export(batch_id: str):
-    with engine.begin() as conn:
-        rows = conn.execute(
-            text("""
-            SELECT deal_id, client_name, deal_value, stage, closing_probability, owner, expected_close_date, source_file
-            FROM deals
-            WHERE batch_id=:batch_id
-            ORDER BY source_file
-            """),
-            {"batch_id": batch_id}
-        ).mappings().all()
-
-    df = pd.DataFrame(list(rows))
-    if df.empty:
-        raise HTTPException(status_code=404, detail="No records found for this batch_id")
-
-    out = io.BytesIO()
-    df.to_excel(out, index=False, sheet_name="ConsolidatedDeals")
+    """
+    Consolidated XLSX for a batch. Rows are streamed from a server-side cursor into an
+    xlsxwriter constant_memory workbook (flushed row by row), spooled to a temp file and
+    sent back in chunks, so memory stays flat regardless of batch size.
+    """
+    out = tempfile.SpooledTemporaryFile(max_size=EXPORT_SPOOL_BYTES)
+    try:
+        with engine.begin() as conn:
+            result = conn.execution_options(stream_results=True, yield_per=1000).execute(
+                text("""
+                SELECT deal_id, client_name, deal_value, stage, closing_probability, owner, expected_close_date, source_file
+                FROM deals
+                WHERE batch_id=:batch_id
+                ORDER BY source_file
+                """),
+                {"batch_id": batch_id}
+            )
+            first = result.fetchone()
+            if first is None:
+                raise HTTPException(status_code=404, detail="No records found for this batch_id")
+
+            wb = xlsxwriter.Workbook(out, {"constant_memory": True})
+            ws = wb.add_worksheet("ConsolidatedDeals")
+            # same header look pandas.to_excel produced
+            header_fmt = wb.add_format({"bold": True, "border": 1, "align": "center", "valign": "top"})
+            ws.write_row(0, 0, list(result.keys()), header_fmt)
+            for row_idx, row in enumerate(chain([first], result), start=1):
+                # NaN/inf can't be written as numbers; leave them blank like pandas.to_excel did
+                ws.write_row(row_idx, 0, [None if isinstance(v, float) and not math.isfinite(v) else v for v in row])
+            wb.close()
+    except BaseException:
+        out.close()
+        raise
     out.seek(0)
 
+    def iter_file():
+        with out:
+            while chunk := out.read(EXPORT_CHUNK_BYTES):
+                yield chunk
+
     filename = f"crm_deals_{batch_id}.xlsx"
     headers = {"Content-Disposition": f'attachment; filename="{filename}"'}
-    return StreamingResponse(out, media_type="application/vnd.openxmlformats-officedocument.spreadsheetml.sheet", headers=headers)
\ No newline at end of file
+    return StreamingResponse(iter_file(), media_type="application/vnd.openxmlformats-officedocument.spreadsheetml.sheet", headers=headers)